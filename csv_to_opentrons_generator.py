@@ -12,18 +12,26 @@ Usage:
 Configuration:
     - Modify CSV_FILE_PATH to point to your CSV file
     - Adjust METADATA and other parameters as needed
+    - Edit LIQUID_DEFINITIONS in this file; it is read-only once imported
+    - Install pyarrow (optional) for faster multithreaded CSV parsing
 """
 
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
+from types import MappingProxyType
 import os
-import json
+import re
 
 # Configuration
 CSV_FILE_PATH = r"c:\Users\User\Downloads\Protocol.py2\Updated_V_gly_V_NaCl_combinations-Tris-A1_D4.csv"
 OUTPUT_FILE_PATH = r"c:\Users\User\Downloads\Protocol.py2\Generated_Protocol.py"
 
+# Write buffer for generated protocol files (1 MiB keeps write() syscalls few)
+WRITE_BUFFER_SIZE = 1 << 20
+
 # Protocol metadata
 METADATA = {
     "protocolName": "Auto-Generated Cloud Point Protocol",
@@ -33,6 +41,8 @@ METADATA = {
 }
 
 # Liquid definitions
+# Read-only: the liquid definitions section of every generated protocol is
+# built from these once at import, so edit them here rather than at runtime
 LIQUID_DEFINITIONS = {
     "glycine": {
         "name": "2.4M Glycine",
@@ -59,11 +69,25 @@ LIQUID_DEFINITIONS = {
         "tube_position": "B2"
     }
 }
+LIQUID_DEFINITIONS = MappingProxyType(
+    {key: MappingProxyType(liquid) for key, liquid in LIQUID_DEFINITIONS.items()}
+)
 
 def read_csv_data(file_path):
     """Read and parse CSV data"""
     try:
-        df = pd.read_csv(file_path)
+        # Prefer the multithreaded pyarrow parser; fall back to the default
+        # C engine when pyarrow is not installed or rejects the file (e.g.
+        # ragged rows, which the C engine pads with NaN)
+        try:
+            df = pd.read_csv(file_path, engine="pyarrow")
+        except (ImportError, ValueError):
+            df = None
+        
+        # pyarrow keeps duplicate headers as-is, which makes df[col] return a
+        # DataFrame; the C engine renames them (e.g. "V_gly.1")
+        if df is None or df.columns.has_duplicates:
+            df = pd.read_csv(file_path, engine="c")
         print(f"Successfully loaded CSV with {len(df)} rows")
         print(f"Columns: {list(df.columns)}")
         return df
@@ -74,16 +98,16 @@ def read_csv_data(file_path):
 def filter_valid_wells(df):
     """Filter out wells with negative water volumes"""
     # Check if water column exists
-    water_cols = [col for col in df.columns if 'water' in col.lower()]
-    if not water_cols:
+    water_col = next((col for col in df.columns if 'water' in col.lower()), None)
+    if water_col is None:
         print("Warning: No water volume column found")
         return df
     
-    water_col = water_cols[0]
     initial_count = len(df)
     
     # Filter positive water volumes
-    df_filtered = df[df[water_col] > 0].copy()
+    # Mask on the raw array; no copy needed since downstream only reads
+    df_filtered = df.loc[df[water_col].to_numpy(copy=False) > 0]
     filtered_count = len(df_filtered)
     
     print(f"Filtered {initial_count - filtered_count} wells with negative water volumes")
@@ -93,41 +117,34 @@ def filter_valid_wells(df):
 
 def segment_data(df, max_wells=28):
     """Segment data into batches of maximum 28 wells"""
-    segments = []
     total_rows = len(df)
     
-    for i in range(0, total_rows, max_wells):
-        segment = df.iloc[i:i+max_wells].copy()
-        segments.append(segment)
-        print(f"Segment {len(segments)}: {len(segment)} wells")
+    # Slices are only read downstream (reset_index already copies), so no .copy()
+    segments = [df.iloc[i:i+max_wells] for i in range(0, total_rows, max_wells)]
+    print(f"Split {total_rows} wells into {len(segments)} segment(s) of up to {max_wells} wells")
     
     return segments
 
 def get_well_positions(df):
     """Extract or generate well positions"""
     # Look for well position column
-    position_cols = [col for col in df.columns if any(x in col.lower() for x in ['well', 'position', 'pos'])]
-    
-    if position_cols:
-        return df[position_cols[0]].tolist()
-    
-    # Generate well positions if not found
-    wells = []
-    rows = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
-    cols = list(range(1, 13))
-    
-    well_idx = 0
-    for _, row in df.iterrows():
-        if well_idx < len(rows) * len(cols):
-            row_idx = well_idx // len(cols)
-            col_idx = well_idx % len(cols) + 1
-            wells.append(f"{rows[row_idx]}{col_idx}")
-            well_idx += 1
-        else:
-            wells.append(f"X{well_idx}")  # Overflow handling
-            well_idx += 1
+    position_col = next((col for col in df.columns if any(x in col.lower() for x in ['well', 'position', 'pos'])), None)
+    
+    if position_col is not None:
+        return df[position_col].tolist()
     
-    return wells
+    # Generate well positions if not found (labels depend only on row number)
+    rows = np.array(['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'])
+    n_cols = 12
+
+    idx = np.arange(len(df))
+    # Row index is clamped only to stay in bounds; labels past the 96th well are
+    # discarded by np.where below in favour of the overflow labels
+    plate_wells = np.char.add(rows[np.minimum(idx // n_cols, len(rows) - 1)], (idx % n_cols + 1).astype(str))
+    overflow_wells = np.char.add("X", idx.astype(str))  # Overflow handling
+    wells = np.where(idx < len(rows) * n_cols, plate_wells, overflow_wells)
+
+    return wells.tolist()
 
 def identify_columns(df):
     """Identify relevant columns in the CSV"""
@@ -141,11 +158,18 @@ def identify_columns(df):
         'water': ['water', 'h2o']
     }
     
-    for liquid, pattern_list in patterns.items():
-        for col in df.columns:
-            if any(pattern in col.lower() for pattern in pattern_list):
+    # One alternation regex per reagent, so each column is scanned in a single pass
+    compiled = {liquid: re.compile("|".join(map(re.escape, pattern_list))) for liquid, pattern_list in patterns.items()}
+    
+    for col in df.columns:
+        lower_col = col.lower()
+        for liquid, pattern in compiled.items():
+            if liquid not in columns and pattern.search(lower_col):
                 columns[liquid] = col
-                break
+    
+    # The single pass above inserts reagents in CSV column order; rebuild in
+    # patterns order on purpose so the result and log line match per-reagent lookup
+    columns = {liquid: columns[liquid] for liquid in patterns if liquid in columns}
     
     print(f"Identified columns: {columns}")
     return columns
@@ -177,9 +201,8 @@ def run(protocol: protocol_api.ProtocolContext) -> None:
 '''
     return header
 
-def generate_labware_section():
-    """Generate labware loading section"""
-    labware = '''    # Load Labware:
+# Labware loading section; static, so built once at import
+_LABWARE_SECTION = '''    # Load Labware:
     tip_rack_1 = protocol.load_labware(
         "opentrons_96_filtertiprack_20ul",
         location="2",
@@ -227,30 +250,40 @@ def generate_labware_section():
         "p300_single_gen2", "left", tip_racks=[tip_rack_2, tip_rack_4],
     )
 '''
-    return labware
 
-def generate_liquid_definitions():
-    """Generate liquid definitions section"""
-    liquids = "    # Define Liquids:\n"
+def generate_labware_section():
+    """Generate labware loading section"""
+    return _LABWARE_SECTION
+
+def _build_liquid_definitions():
+    """Build liquid definitions section from LIQUID_DEFINITIONS"""
+    parts = ["    # Define Liquids:\n"]
     
     for i, (key, liquid) in enumerate(LIQUID_DEFINITIONS.items(), 1):
-        liquids += f'''    liquid_{i} = protocol.define_liquid(
+        parts.append(f'''    liquid_{i} = protocol.define_liquid(
         "{liquid['name']}",
         description="{liquid['description']}",
         display_color="{liquid['color']}",
     )
-'''
+''')
     
-    liquids += "\n    # Load Liquids:\n"
+    parts.append("\n    # Load Liquids:\n")
     for i, (key, liquid) in enumerate(LIQUID_DEFINITIONS.items(), 1):
-        liquids += f'''    tube_rack_1.load_liquid(
+        parts.append(f'''    tube_rack_1.load_liquid(
         wells=["{liquid['tube_position']}"],
         liquid=liquid_{i},
         volume=10000,
     )
-'''
+''')
     
-    return liquids
+    return "".join(parts)
+
+# Liquid definitions section; depends only on LIQUID_DEFINITIONS, so built once at import
+_LIQUID_DEFINITIONS_SECTION = _build_liquid_definitions()
+
+def generate_liquid_definitions():
+    """Generate liquid definitions section"""
+    return _LIQUID_DEFINITIONS_SECTION
 
 def select_pipette(volume):
     """Select appropriate pipette based on volume"""
@@ -259,33 +292,15 @@ def select_pipette(volume):
     else:
         return "pipette_left", "p300_single_gen2"
 
-def generate_liquid_class(step_name, pipette_type, volume, liquid_name=None):
-    """Generate liquid class definition"""
-    
-    if pipette_type == "p20_single_gen2":
-        tip_rack = "opentrons/opentrons_96_filtertiprack_20ul/1"
-        flow_rate = 7.56
-    else:
-        tip_rack = "opentrons/opentrons_96_filtertiprack_200ul/1"
-        flow_rate = 46.4
-    
-    # Disable mixing for buffer (Tris) transfers - handled in mix_config below
-    
-    # Set push-out volume based on pipette type and volume to avoid exceeding max blowout
-    if pipette_type == "p20_single_gen2":
-        # For p20, use smaller push-out volume, max 2 µL or 20% of volume, whichever is smaller
-        push_out_volume = int(round(min(2, max(0.5, volume * 0.2))))
-    else:
-        # For p300, use standard push-out volume
-        push_out_volume = int(round(min(5, max(1, volume * 0.1))))
-    
-    # Generate mix configuration - simpler format for Tris buffer
-    if liquid_name == "tris":
-        mix_config = '"mix": {"enabled": False},'
-    else:
-        mix_config = f'"mix": {{"enabled": True, "repetitions": 5, "volume": {min(20, volume//2)}}},'
-    
-    return f'''        liquid_class=protocol.define_liquid_class(
+# Tip rack and flow rate used in the liquid class for each pipette
+_LIQUID_CLASS_PIPETTE_SETTINGS = {
+    "p20_single_gen2": ("opentrons/opentrons_96_filtertiprack_20ul/1", 7.56),
+    "p300_single_gen2": ("opentrons/opentrons_96_filtertiprack_200ul/1", 46.4),
+}
+
+# Liquid class definition template, rendered once per (pipette_type, volume,
+# liquid_name) by _liquid_class_body and cached
+_LIQUID_CLASS_TEMPLATE = '''        liquid_class=protocol.define_liquid_class(
             name="{step_name}",
             properties={{"{pipette_type}": {{"{tip_rack}": {{
                 "aspirate": {{
@@ -355,13 +370,54 @@ def generate_liquid_class(step_name, pipette_type, volume, liquid_name=None):
             }}}}}},
         ),'''
 
+# Stands in for the step name in cached liquid class bodies
+_STEP_NAME_PLACEHOLDER = "__STEP_NAME__"
+
+@lru_cache(maxsize=None, typed=True)
+def _liquid_class_body(pipette_type, volume, liquid_name):
+    """Render liquid class definition with a placeholder step name"""
+    
+    tip_rack, flow_rate = _LIQUID_CLASS_PIPETTE_SETTINGS.get(
+        pipette_type, _LIQUID_CLASS_PIPETTE_SETTINGS["p300_single_gen2"]
+    )
+    
+    # Disable mixing for buffer (Tris) transfers - handled in mix_config below
+    
+    # Set push-out volume based on pipette type and volume to avoid exceeding max blowout
+    if pipette_type == "p20_single_gen2":
+        # For p20, use smaller push-out volume, max 2 µL or 20% of volume, whichever is smaller
+        push_out_volume = int(round(min(2, max(0.5, volume * 0.2))))
+    else:
+        # For p300, use standard push-out volume
+        push_out_volume = int(round(min(5, max(1, volume * 0.1))))
+    
+    # Generate mix configuration - simpler format for Tris buffer
+    if liquid_name == "tris":
+        mix_config = '"mix": {"enabled": False},'
+    else:
+        mix_config = f'"mix": {{"enabled": True, "repetitions": 5, "volume": {min(20, volume//2)}}},'
+    
+    return _LIQUID_CLASS_TEMPLATE.format(
+        step_name=_STEP_NAME_PLACEHOLDER,
+        pipette_type=pipette_type,
+        tip_rack=tip_rack,
+        flow_rate=flow_rate,
+        push_out_volume=push_out_volume,
+        mix_config=mix_config,
+    )
+
+def generate_liquid_class(step_name, pipette_type, volume, liquid_name=None):
+    """Generate liquid class definition"""
+    # Only the step name differs between steps sharing pipette, volume and liquid
+    return _liquid_class_body(pipette_type, volume, liquid_name).replace(_STEP_NAME_PLACEHOLDER, step_name)
+
 def generate_transfer_step(step_num, volume, source_tube, dest_wells, liquid_name, columns):
     """Generate a single transfer step"""
     
     pipette, pipette_type = select_pipette(volume)
     
-    # Build source list
-    source_list = f'[tube_rack_1["{source_tube}"]' + f', tube_rack_1["{source_tube}"]' * (len(dest_wells) - 1) + ']'
+    # Build source list - one entry per destination, repeated by the protocol at runtime
+    source_list = f'[tube_rack_1["{source_tube}"]] * {len(dest_wells)}'
     
     # Build destination list
     dest_list = '[' + ', '.join([f'well_plate_1["{well}"]' for well in dest_wells]) + ']'
@@ -382,6 +438,15 @@ def generate_transfer_step(step_num, volume, source_tube, dest_wells, liquid_nam
     
     return step
 
+def bucket_by_volume(volumes):
+    """Bucket row positions by volume value using numpy only"""
+    # Stable sort, then split at each new value: the rows holding
+    # unique_volumes[i] are order[starts[i]:ends[i]], in original row order
+    order = np.argsort(volumes, kind="stable")
+    unique_volumes, starts = np.unique(volumes[order], return_index=True)
+    ends = np.r_[starts[1:], len(order)]
+    return order, unique_volumes, starts, ends
+
 def group_by_reagent_and_volume(df, columns, well_positions):
     """Group transfers by reagent type and volume for efficient liquid handling"""
     transfers = []
@@ -396,15 +461,14 @@ def group_by_reagent_and_volume(df, columns, well_positions):
         col_name = columns[reagent]
         source_tube = LIQUID_DEFINITIONS[reagent]['tube_position']
         
-        # Group by volume
-        volume_groups = df.groupby(col_name)
+        order, unique_volumes, starts, ends = bucket_by_volume(df[col_name].to_numpy(copy=False))
         
-        for volume, group in volume_groups:
-            if volume <= 0:
+        for volume, start, end in zip(unique_volumes, starts, ends):
+            if not volume > 0:  # also skips NaN, which groupby used to drop
                 continue
                 
             # Get well positions for this volume
-            wells = [well_positions[idx] for idx in group.index]
+            wells = [well_positions[idx] for idx in order[start:end]]
             
             transfers.append({
                 'reagent': reagent,
@@ -417,8 +481,7 @@ def group_by_reagent_and_volume(df, columns, well_positions):
     return transfers
 
 def generate_protocol_steps_for_segment(df_segment, columns, segment_idx=1):
-    """Generate protocol steps for a single segment"""
-    steps = ""
+    """Yield protocol steps for a single segment, one transfer step at a time"""
     step_counter = 1
     
     # Get well positions for this segment
@@ -441,13 +504,38 @@ def generate_protocol_steps_for_segment(df_segment, columns, segment_idx=1):
                 transfer['reagent'],
                 columns
             )
-            steps += step
+            yield step
             step_counter += 1
+
+def write_protocol_file(file_path, chunks):
+    """Stream protocol chunks to file_path and return the number of lines written"""
+    # Write to a temp file next to the target and rename it into place only on
+    # success, so a failed generation or write never leaves a partial protocol
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    
+    # Count lines as they are written so the file never has to be re-read
+    line_count = 0
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                line_count += chunk.count("\n")
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        # Only clean up the temp file this run created; file_path is untouched
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
     
-    return steps
+    return line_count
 
 def generate_full_protocol(csv_path):
-    """Generate complete protocol from CSV, creating separate files for each segment"""
+    """Generate complete protocol from CSV, creating separate files for each segment
+    
+    Returns a list of (file_path, line_count) tuples, one per written segment.
+    """
     
     print(f"Processing CSV file: {csv_path}")
     
@@ -466,6 +554,14 @@ def generate_full_protocol(csv_path):
     segments = segment_data(df_filtered)
     total_segments = len(segments)
     
+    # Extract directory and filename without extension
+    output_dir = os.path.dirname(OUTPUT_FILE_PATH)
+    base_filename = os.path.splitext(os.path.basename(OUTPUT_FILE_PATH))[0]
+    
+    # Ensure the directory exists (all segment files share it)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
     # Generate protocol files for each segment
     generated_files = []
     
@@ -475,34 +571,29 @@ def generate_full_protocol(csv_path):
         
         # Create unique filename for each segment
         if total_segments > 1:
-            # Extract directory and filename without extension
-            output_dir = os.path.dirname(OUTPUT_FILE_PATH)
-            base_filename = os.path.splitext(os.path.basename(OUTPUT_FILE_PATH))[0]
             segment_file_path = os.path.join(output_dir, f"{base_filename}_Segment_{segment_num}.py")
         else:
             segment_file_path = OUTPUT_FILE_PATH
         
-        # Ensure the directory exists
-        output_dir = os.path.dirname(segment_file_path)
-        if output_dir and not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
         print(f"Generating Segment {segment_num}/{total_segments}: {wells_in_segment} wells -> {os.path.basename(segment_file_path)}")
         
-        # Generate protocol sections for this segment
-        protocol_code = generate_protocol_header(segment_num, total_segments, wells_in_segment)
-        protocol_code += generate_labware_section()
-        protocol_code += generate_liquid_definitions()
-        protocol_code += f"\n    # PROTOCOL STEPS - SEGMENT {segment_num}/{total_segments} ({wells_in_segment} wells)\n"
-        protocol_code += generate_protocol_steps_for_segment(df_segment, columns, segment_idx)
+        # Generate protocol sections for this segment, streaming each one to the file
+        chunks = chain(
+            (
+                generate_protocol_header(segment_num, total_segments, wells_in_segment),
+                generate_labware_section(),
+                generate_liquid_definitions(),
+                f"\n    # PROTOCOL STEPS - SEGMENT {segment_num}/{total_segments} ({wells_in_segment} wells)\n",
+            ),
+            generate_protocol_steps_for_segment(df_segment, columns, segment_idx),
+        )
         
-        # Write segment file
+        # Generation errors propagate; only write failures are reported and skipped
         try:
-            with open(segment_file_path, 'w', encoding='utf-8') as f:
-                f.write(protocol_code)
-            generated_files.append(segment_file_path)
+            line_count = write_protocol_file(segment_file_path, chunks)
+            generated_files.append((segment_file_path, line_count))
             print(f"✅ Segment {segment_num} saved successfully")
-        except Exception as e:
+        except OSError as e:
             print(f"❌ Error writing segment {segment_num}: {e}")
     
     return generated_files
@@ -525,13 +616,7 @@ def main():
     if generated_files:
         print(f"\n✅ Protocol generation completed!")
         print(f"📁 Generated {len(generated_files)} protocol file(s):")
-        for i, file_path in enumerate(generated_files, 1):
-            lines = 0
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = len(f.readlines())
-            except:
-                pass
+        for i, (file_path, lines) in enumerate(generated_files, 1):
             print(f"   {i}. {os.path.basename(file_path)} ({lines} lines)")
         print(f"\n� Summary:")
         print(f"   - Total segments: {len(generated_files)}")